@@ -16,6 +16,11 @@ The commit exported have the following properties:
     - The commit has only one parent. This is to avoid ambiguity where we don't know which parent was diffed against to manually label the lines.
     - The commit contains at least one code change. Documentation, tests, and whitespace related changes are ignored.
 
+The script expects the indexes declared by the pycoshark models to look up the file actions of a commit and the hunks
+of a file action. They are ensured at startup if the database user is allowed to create them:
+    - file_action.commit_id
+    - hunk.file_action_id (hashed)
+
 References:
 1. Herbold, Steffen, et al. "A fine-grained data set and analysis of tangling in bug fixing commits." Empirical Software Engineering 27.6 (2022): 125.
 
@@ -31,6 +36,7 @@ import sys
 from typing import List
 
 from mongoengine import connect
+from pymongo.errors import OperationFailure
 from pycoshark.mongomodels import (
     Project,
     VCSSystem,
@@ -85,9 +91,9 @@ LINE_LABELS = [
     "whitespace",
     "no_bugfix",
 ]
-LINE_LABELS_CODE_FIX = ["bugfix"]
-LINE_LABELS_CODE_NO_FIX = ["refactoring", "unrelated", "no_bugfix"]
-LINE_LABELS_CODE = LINE_LABELS_CODE_FIX + LINE_LABELS_CODE_NO_FIX
+LINE_LABELS_CODE_FIX = frozenset(["bugfix"])
+LINE_LABELS_CODE_NO_FIX = frozenset(["refactoring", "unrelated", "no_bugfix"])
+LINE_LABELS_CODE = LINE_LABELS_CODE_FIX | LINE_LABELS_CODE_NO_FIX
 
 
 def connect_to_db():
@@ -115,6 +121,30 @@ def connect_to_db():
         )
 
 
+def bugfix_commits_query(vcs_system_id) -> dict:
+    """
+    Returns the MongoDB query selecting the commits of a VCS system that are
+    labelled as bugfix by developers and researchers and that have only one parent.
+    """
+    return {
+        "vcs_system_id": vcs_system_id,
+        "labels.validated_bugfix": True,
+        "parents": {"$size": 1},
+    }
+
+
+def create_indexes():
+    """
+    Ensures the indexes declared by the pycoshark models used to join commits, file actions, and hunks.
+    Read-only users are not allowed to create indexes, in which case the existing indexes are used.
+    """
+    try:
+        FileAction.ensure_indexes()
+        Hunk.ensure_indexes()
+    except OperationFailure as e:
+        print(f"Could not create indexes: {e}", file=sys.stderr)
+
+
 def label_lines(hunks: List[Hunk]) -> pd.DataFrame:
     """
     Groups line changes into two groups for the given hunks. Only lines representing
@@ -178,17 +208,19 @@ def export_ground_truth_for_commit(commit) -> pd.DataFrame:
         and len(commit.parents) == 1
     ):
         file_frames = []
-        for fa in FileAction.objects(commit_id=commit.id):
+        for fa in FileAction.objects(commit_id=commit.id).only(
+            "id", "file_id", "old_file_id", "mode"
+        ):
             file = None
 
             if fa.old_file_id:
-                file = File.objects(id=fa.old_file_id).get()
+                file = File.objects(id=fa.old_file_id).only("path").get()
 
             if not file or fa.mode == "R":
                 # If the file was renamed, prefer the new file instead of the old file.
                 # This behaviour is consistent with the unidiff library we use
                 # in our evaluation framework.
-                file = File.objects(id=fa.file_id).get()
+                file = File.objects(id=fa.file_id).only("path").get()
 
             if (
                 not file.path.endswith(".java")
@@ -197,7 +229,11 @@ def export_ground_truth_for_commit(commit) -> pd.DataFrame:
             ):
                 continue
 
-            hunks_df = label_lines(Hunk.objects(file_action_id=fa.id))
+            hunks_df = label_lines(
+                Hunk.objects(file_action_id=fa.id).only(
+                    "content", "lines_verified", "old_start", "new_start", "old_lines"
+                )
+            )
             hunks_df["file"] = file.path
             file_frames.append(hunks_df)
         if len(file_frames) == 0:
@@ -245,7 +281,10 @@ def export_lltc4j(out_dir: str, projects: List[str], number: int):
     for project in Project.objects(name__in=projects):
         print(f"Processing project {project.name}", file=sys.stderr)
         vcs_system = VCSSystem.objects(project_id=project.id).get()
-        for commit in tqdm(Commit.objects(vcs_system_id=vcs_system.id), desc="Commits"):
+        commits = Commit.objects(__raw__=bugfix_commits_query(vcs_system.id)).only(
+            "id", "labels", "parents", "revision_hash"
+        )
+        for commit in tqdm(commits, desc="Commits"):
             # Early exit if we have processed enough commits.
             if number is not None and exported_commits_counter >= number:
                 early_exit = True
@@ -330,6 +369,7 @@ def main():
         raise ValueError(f"Directory {out_dir} does not exist.")
 
     connect_to_db()
+    create_indexes()
     export_lltc4j(out_dir, args.projects, args.number)
 
 
@@ -4,15 +4,31 @@
 This script list commits in the LLTC4J dataset[1] that have tangled lines.
 A line is tangled when the LLTC4J authors labelled it with more than one type of change.
 Commits with tangled lines are outputted on the standard output.
+Set the environment variable LLTC4J_DEBUG=1 to print each tangled line and its labels on the standard error.
+
+The tangled commits of each project are cached in ~/.cache/lltc4j/tangled_commits.db, keyed by cache format version,
+project, VCS system, and tangle granularity. Since the dataset doesn't change, later runs reuse the cached results.
+The cache is not read when LLTC4J_DEBUG=1 is set, so that every tangled line is printed.
+
+Arguments:
+    tangle_granularity. Required argument to specify the granularity of the tangled changes, either `hunk` or `line`.
+    --refresh. Optional argument to scan all projects again and update the cache.
 
 References:
 1. Herbold, Steffen, et al. "A fine-grained data set and analysis of tangling in bug fixing commits." Empirical Software Engineering 27.6 (2022): 125.
 """
 
 import argparse
-from typing import List
-
-from defaultlist import defaultlist
+import multiprocessing
+import os
+import re
+import shelve
+import sys
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import pandas as pd
+from bson import ObjectId
+from mongoengine import disconnect
 from pycoshark.mongomodels import (
     Project,
     VCSSystem,
@@ -22,147 +38,319 @@ from pycoshark.mongomodels import (
     File,
 )
 
-from export_lltc4j import connect_to_db
+from export_lltc4j import bugfix_commits_query, connect_to_db, create_indexes
 from export_lltc4j import (
     PROJECTS,
-    LINE_LABELS_CODE,
     LINE_LABELS_CODE_FIX,
     LINE_LABELS_CODE_NO_FIX,
 )
 
+# Number of file actions MongoDB returns per round-trip while iterating over a project.
+FILE_ACTION_BATCH_SIZE = 1000
+
+DEBUG = os.environ.get("LLTC4J_DEBUG") == "1"
+
+CACHE_FILE = os.path.expanduser("~/.cache/lltc4j/tangled_commits.db")
+# Bump when the cached results change format or meaning so that stale entries are not reused.
+CACHE_VERSION = 1
 
-def count_tangled_lines(hunks: List[Hunk], commit_hash: str) -> int:
+JAVA_FILE_REGEX = re.compile(r"\.java$")
+# Matches paths containing a test/ or tests/ directory, and Java files named *Test or *Tests.
+TEST_FILE_REGEX = re.compile(r"tests?/|Tests?\.java$")
+
+# Kind of change of each code label, used to find hunks mixing both kinds.
+LABEL_KINDS = {
+    **{label: "fix" for label in LINE_LABELS_CODE_FIX},
+    **{label: "nofix" for label in LINE_LABELS_CODE_NO_FIX},
+}
+
+
+def print_tangled_lines(hunk: dict, commit_hash: str):
     """
-    Returns the count of tangled lines in the given hunk list.
+    Prints the tangled lines of the given hunk and their labels on the standard error.
 
-    :param hunks: The hunks to check in the commit.
+    :param hunk: The hunk to check, as a raw dict.
     :param commit_hash: The hash of the commit.
     """
-    tangled_lines_count = 0
-    for hunk in hunks:
-        hunk_content_by_line = hunk.content.splitlines()
-        line_labels = defaultlist()
+    line_labels: Dict[int, str] = {}
 
-        for label, offset_line_numbers in hunk.lines_verified.items():
-            for i in offset_line_numbers:
-                if line_labels[i]:
-                    tangled_lines_count += 1
-                    print(f"Tangled line in {commit_hash}: {hunk_content_by_line[i]}")
-                    print(f"Found label {line_labels[i]} and {label}")
-                line_labels[i] = label
-    return tangled_lines_count
+    for label, offset_line_numbers in hunk.get("lines_verified", {}).items():
+        for i in offset_line_numbers:
+            if i in line_labels:
+                # Only split the content up to the tangled line.
+                line = hunk["content"].split("\n", i + 1)[i]
+                print(f"Tangled line in {commit_hash}: {line}", file=sys.stderr)
+                print(f"Found label {line_labels[i]} and {label}", file=sys.stderr)
+            line_labels[i] = label
 
 
-def count_tangled_hunks(hunks: List[Hunk], commit_hash: str) -> int:
+def count_tangled_lines(hunks: Iterable[Tuple[str, dict]]) -> pd.Series:
     """
-    Returns the count of tangled hunks in the given hunk list.
+    Returns the count of tangled lines of each commit in the given hunks, indexed by commit hash.
+    A line labelled n times counts as n - 1 tangled lines.
 
-    :param hunks: The hunks to check in the commit.
-    :param commit_hash: The hash of the commit.
+    :param hunks: The hunks to check as (commit_hash, hunk) pairs. The hunks are raw dicts.
+        A hunk without lines_verified has no labelled lines. The hunks are only kept in debug mode.
     """
-    tangled_hunks_count = 0
-    for hunk in hunks:
-        # If hunk contains only bug fixing changes and non bug fixing changes, return false.
-        seen_labels = set()
-
-        for label, _ in hunk.lines_verified.items():
-            if label not in LINE_LABELS_CODE:
-                continue
+    # The content of the tangled hunks is only needed to print their tangled lines.
+    debug_hunks: List[Tuple[str, dict]] = []
+
+    def line_records():
+        for hunk_id, (commit_hash, hunk) in enumerate(hunks):
+            if DEBUG:
+                debug_hunks.append((commit_hash, hunk))
+            for offset_line_numbers in hunk.get("lines_verified", {}).values():
+                for offset in offset_line_numbers:
+                    yield commit_hash, hunk_id, offset
+
+    lines = pd.DataFrame.from_records(
+        line_records(), columns=["commit_hash", "hunk_id", "offset"]
+    )
+    tangled_lines = (
+        lines.groupby(["commit_hash", "hunk_id", "offset"], sort=False).size() - 1
+    )
 
-            if label in LINE_LABELS_CODE_FIX:
-                seen_labels.add("fix")
-            elif label in LINE_LABELS_CODE_NO_FIX:
-                seen_labels.add("nofix")
+    if DEBUG:
+        tangled_hunk_ids = tangled_lines[tangled_lines > 0].index.unique("hunk_id")
+        for hunk_id in tangled_hunk_ids:
+            commit_hash, hunk = debug_hunks[hunk_id]
+            print_tangled_lines(hunk, commit_hash)
 
-            if len(seen_labels) == 2:
-                tangled_hunks_count += 1
-    return tangled_hunks_count
+    return tangled_lines.groupby(level="commit_hash", sort=False).sum()
 
 
-def is_java_file(file: File) -> bool:
+def count_tangled_hunks(hunks: Iterable[Tuple[str, dict]]) -> pd.Series:
     """
-    Returns true if the given file is a Java file.
+    Returns the count of tangled hunks of each commit in the given hunks, indexed by commit hash.
+    A hunk is tangled when it contains both bug fixing and non bug fixing changes.
+
+    :param hunks: The hunks to check as (commit_hash, hunk) pairs. The hunks are raw dicts.
+        A hunk without lines_verified has no labelled lines.
     """
-    return file.path.endswith(".java")
+    labels = pd.DataFrame.from_records(
+        (
+            (commit_hash, hunk_id, label)
+            for hunk_id, (commit_hash, hunk) in enumerate(hunks)
+            for label in hunk.get("lines_verified", {})
+        ),
+        columns=["commit_hash", "hunk_id", "label"],
+    )
+    labels["kind"] = labels["label"].map(LABEL_KINDS)
+    kinds_by_hunk = (
+        labels.dropna(subset=["kind"])
+        .groupby(["commit_hash", "hunk_id"], sort=False)["kind"]
+        .nunique()
+    )
+    return (kinds_by_hunk == 2).groupby(level="commit_hash", sort=False).sum()
 
 
-def is_test_file(file: File) -> bool:
+def count_tangled_changes_by_commit(
+    file_actions: Iterable[dict], granularity_count_func
+) -> Dict[str, int]:
     """
-    Returns true if the given file is a Java test file.
+    Returns the count of tangled changes of each tangled commit, indexed by commit hash.
+    The count of a commit covers the hunks of all its file actions.
+
+    :param file_actions: The file actions, as returned by #bugfix_file_actions_pipeline().
+    :param granularity_count_func: The function counting the tangled changes of each commit in the given hunks.
     """
-    return (
-        "test/" in file.path
-        or "tests/" in file.path
-        or file.path.endswith("Test.java")
-        or file.path.endswith("Tests.java")
-    )
+    # The hunks are streamed from the file actions so that only the counting
+    # records of a project are held in memory, not its hunks.
+    hunks = ((fa["revision_hash"], hunk) for fa in file_actions for hunk in fa["hunks"])
+    return {
+        commit_hash: int(tangled_changes_count)
+        for commit_hash, tangled_changes_count in granularity_count_func(hunks).items()
+        if tangled_changes_count
+    }
+
+
+def bugfix_file_actions_pipeline(vcs_system_id: ObjectId) -> List[dict]:
+    """
+    Returns the aggregation pipeline joining the validated bug fixes with a single
+    parent of a VCS system with their file actions, changed files, and hunks.
+
+    Only the file actions changing Java files that are not tests are kept. They are
+    filtered before joining the hunks so that the hunks of the other files are never
+    sent by the database.
 
+    The pipeline outputs one document per file action with the following fields:
+    - revision_hash: The hash of the commit.
+    - hunks: The lines_verified of the hunks of the file action. Their content is
+      only included in debug mode to print the tangled lines.
 
-def get_changed_file(fa: FileAction) -> File:
+    :param vcs_system_id: The id of the VCS system of the project.
+    """
+    return [
+        {"$match": bugfix_commits_query(vcs_system_id)},
+        {"$project": {"revision_hash": 1}},
+        {
+            "$lookup": {
+                "from": FileAction._get_collection_name(),
+                "localField": "_id",
+                "foreignField": "commit_id",
+                "as": "file_action",
+            }
+        },
+        {"$unwind": "$file_action"},
+        {
+            "$project": {
+                "revision_hash": 1,
+                "file_action._id": 1,
+                # If the file was renamed, prefer the new file instead of the old file.
+                # This behaviour is consistent with the unidiff library we use
+                # in our evaluation framework. If there is no file_id, the file
+                # was deleted. We use the old_file_id.
+                "file_id": {
+                    "$ifNull": ["$file_action.file_id", "$file_action.old_file_id"]
+                },
+            }
+        },
+        {
+            "$lookup": {
+                "from": File._get_collection_name(),
+                "localField": "file_id",
+                "foreignField": "_id",
+                "as": "file",
+            }
+        },
+        {
+            "$project": {
+                "revision_hash": 1,
+                "file_action._id": 1,
+                "path": {"$arrayElemAt": ["$file.path", 0]},
+            }
+        },
+        {
+            "$match": {
+                "path": {"$regex": JAVA_FILE_REGEX.pattern, "$not": TEST_FILE_REGEX}
+            }
+        },
+        {
+            "$lookup": {
+                "from": Hunk._get_collection_name(),
+                "localField": "file_action._id",
+                "foreignField": "file_action_id",
+                "as": "hunks",
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "revision_hash": 1,
+                "hunks.lines_verified": 1,
+                **({"hunks.content": 1} if DEBUG else {}),
+            }
+        },
+    ]
+
+
+def get_granularity_count_func(
+    tangle_granularity: str,
+) -> Callable[[Iterable[Tuple[str, dict]]], pd.Series]:
     """
-    Returns the changed file from the given file action.
-    If the file was renamed, the new file is returned. If the file was deleted,
-    the old file is returned.
+    Returns the function counting the tangled changes for the given granularity.
+
+    :param tangle_granularity: The granularity of the tangled changes to look for.
     """
-    if fa.file_id:
-        # If the file was renamed, prefer the new file instead of the old file.
-        # This behaviour is consistent with the unidiff library we use
-        # in our evaluation framework.
-        file = File.objects(id=fa.file_id).get()
-    else:
-        # If there is no file_id, the file was deleted. We use the old_file_id.
-        file = File.objects(id=fa.old_file_id).get()
-    return file
+    if tangle_granularity == "hunk":
+        return count_tangled_hunks
+    if tangle_granularity == "line":
+        return count_tangled_lines
+    raise ValueError(f"Unknown tangle granularity: {tangle_granularity}")
 
 
-def count_tangled_changes(commit, granularity_count_func) -> int:
+def scan_project(
+    project_name: str, tangle_granularity: str
+) -> List[Tuple[str, str, int]]:
     """
-    Returns the count of tangled changes given the tangle function.
+    Returns the tangled commits of a project as (project_name, commit_hash, tangled_changes_count) tuples.
+
+    This function runs in a worker process. It opens its own connection to the
+    database because a MongoDB client cannot be shared across a fork.
+
+    :param project_name: The name of the project to scan.
+    :param tangle_granularity: The granularity of the tangled changes to look for.
     """
-    tangled_changes_count = 0
-    if (
-        commit.labels is not None
-        and "validated_bugfix" in commit.labels
-        and commit.labels["validated_bugfix"]
-        and len(commit.parents) == 1
-    ):
-        for fa in FileAction.objects(commit_id=commit.id):
-            file = get_changed_file(fa)
-            if not is_java_file(file) or is_test_file(file):
-                continue
-            tangled_changes_count += granularity_count_func(
-                Hunk.objects(file_action_id=fa.id), commit.revision_hash
-            )
-    return tangled_changes_count
+    granularity_count_func = get_granularity_count_func(tangle_granularity)
+    connect_to_db()
+
+    project = Project.objects(name=project_name).first()
+    if project is None:
+        return []
+
+    print(f"Processing project {project_name}", file=sys.stderr)
+    vcs_system = VCSSystem.objects(project_id=project.id).get()
+    tangled_changes_counts = count_tangled_changes_by_commit(
+        Commit._get_collection().aggregate(
+            bugfix_file_actions_pipeline(vcs_system.id),
+            allowDiskUse=True,
+            batchSize=FILE_ACTION_BATCH_SIZE,
+        ),
+        granularity_count_func,
+    )
+    return [
+        (project_name, commit_hash, tangled_changes_count)
+        for commit_hash, tangled_changes_count in tangled_changes_counts.items()
+    ]
 
 
-def list_tangled_commits(tangle_granularity: str) -> List:
+def list_tangled_commits(tangle_granularity: str, refresh: bool = False):
     """
     List commits with tangled commits in the LLTC4J dataset. The commits are outputted
     on the standard output in CSV format with the following header: <project_name>,<commit_hash>,<tangled_changes_count>.
     The tangled changes count varies depending on the tangling granularity.
 
+    The projects missing from the cache are scanned in parallel, one process per project.
+    Their results are then added to the cache. In debug mode, all projects are scanned
+    to print their tangled lines.
+
     :param tangle_granularity: The granularity of the tangled changes to look for.
+    :param refresh: Whether to scan all projects again instead of using the cache.
     """
-    granularity_count_func = None
-    if tangle_granularity == "hunk":
-        granularity_count_func = count_tangled_hunks
-    elif tangle_granularity == "line":
-        granularity_count_func = count_tangled_lines
-    else:
-        raise ValueError(f"Unknown tangle granularity: {tangle_granularity}")
+    # Fail before starting the workers if the granularity is invalid.
+    get_granularity_count_func(tangle_granularity)
 
     connect_to_db()
-
-    print("project,commit,tangled_changes_count")
+    create_indexes()
+    vcs_system_ids = {}
     for project in Project.objects(name__in=PROJECTS):
         vcs_system = VCSSystem.objects(project_id=project.id).get()
-        for commit in Commit.objects(vcs_system_id=vcs_system.id):
-            tangled_changes_count = count_tangled_changes(
-                commit, granularity_count_func
-            )
-            if tangled_changes_count:
-                print(f"{project.name},{commit.revision_hash},{tangled_changes_count}")
+        vcs_system_ids[project.name] = vcs_system.id
+    # The workers open their own connection.
+    disconnect()
+
+    os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+    with shelve.open(CACHE_FILE) as cache:
+        cache_keys = {
+            project_name: f"v{CACHE_VERSION}/{project_name}/{vcs_system_id}/{tangle_granularity}"
+            for project_name, vcs_system_id in vcs_system_ids.items()
+        }
+        projects_to_scan = [
+            project_name
+            for project_name in PROJECTS
+            if project_name in cache_keys
+            and (refresh or DEBUG or cache_keys[project_name] not in cache)
+        ]
+
+        if projects_to_scan:
+            with multiprocessing.Pool(len(projects_to_scan)) as pool:
+                tangled_commits_by_project = pool.starmap(
+                    scan_project,
+                    [(project, tangle_granularity) for project in projects_to_scan],
+                )
+            for project_name, tangled_commits in zip(
+                projects_to_scan, tangled_commits_by_project
+            ):
+                cache[cache_keys[project_name]] = tangled_commits
+
+        print("project,commit,tangled_changes_count")
+        for project_name in PROJECTS:
+            if project_name not in cache_keys:
+                continue
+            for _, commit_hash, tangled_changes_count in cache[
+                cache_keys[project_name]
+            ]:
+                print(f"{project_name},{commit_hash},{tangled_changes_count}")
 
 
 def main():
@@ -181,8 +369,14 @@ def main():
         help="The untangling granularity.",
     )
 
+    main_parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Scan all projects again instead of reusing the cached results.",
+    )
+
     args = main_parser.parse_args()
-    list_tangled_commits(args.tangle_granularity)
+    list_tangled_commits(args.tangle_granularity, args.refresh)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,205 @@
+"""
+Regression tests for the script listing tangled commits.
+"""
+
+import pytest
+from bson import ObjectId
+
+import list_tangled_commits
+from list_tangled_commits import (
+    count_tangled_changes_by_commit,
+    count_tangled_hunks,
+    count_tangled_lines,
+    bugfix_file_actions_pipeline,
+    JAVA_FILE_REGEX,
+    TEST_FILE_REGEX,
+)
+
+
+def test_count_tangled_lines_no_tangle():
+    """
+    Test count_tangled_lines() with lines that have a single label each.
+    """
+    hunk = {
+        "content": "- A\n+ B",
+        "lines_verified": {"bugfix": [0], "refactoring": [1]},
+    }
+    assert count_tangled_lines([("abc123", hunk)]).get("abc123", 0) == 0
+
+
+def test_count_tangled_lines_tangled():
+    """
+    Test count_tangled_lines() with a line labelled twice.
+    """
+    hunk = {
+        "content": "- A\n+ B",
+        "lines_verified": {"bugfix": [0, 1], "refactoring": [1]},
+    }
+    assert count_tangled_lines([("abc123", hunk)])["abc123"] == 1
+
+
+def test_count_tangled_lines_sparse_offsets():
+    """
+    Test count_tangled_lines() with labelled lines far apart in the hunk.
+    """
+    content = [f"+ line {i}" for i in range(1000)]
+    hunk = {
+        "content": "\n".join(content),
+        "lines_verified": {"bugfix": [2, 999], "unrelated": [999]},
+    }
+    assert count_tangled_lines([("abc123", hunk)])["abc123"] == 1
+
+
+def test_count_tangled_lines_without_lines_verified():
+    """
+    Test count_tangled_lines() with a hunk that has no lines_verified field.
+    """
+    hunk = {"content": "- A\n+ B"}
+    assert count_tangled_lines([("abc123", hunk)]).get("abc123", 0) == 0
+
+
+def test_count_tangled_lines_debug_prints_streamed_hunks(monkeypatch, capsys):
+    """
+    Test that count_tangled_lines() prints the tangled lines of hunks read from
+    a single-pass iterator in debug mode.
+    """
+    monkeypatch.setattr(list_tangled_commits, "DEBUG", True)
+    hunks = [
+        ("abc123", {"content": "- A\n+ B", "lines_verified": {"bugfix": [0]}}),
+        (
+            "def456",
+            {"content": "- C\n+ D", "lines_verified": {"bugfix": [1], "test": [1]}},
+        ),
+    ]
+    counts = count_tangled_lines(iter(hunks))
+    assert counts.get("def456", 0) == 1
+    assert "Tangled line in def456: + D" in capsys.readouterr().err
+
+
+def test_count_tangled_hunks_fix_only():
+    """
+    Test count_tangled_hunks() with a hunk containing only bug fixing changes.
+    """
+    hunk = {
+        "content": "- A\n+ B\n+ C",
+        "lines_verified": {"bugfix": [0, 1], "documentation": [2]},
+    }
+    assert count_tangled_hunks([("abc123", hunk)]).get("abc123", 0) == 0
+
+
+def test_count_tangled_hunks_counted_once():
+    """
+    Test that count_tangled_hunks() counts a tangled hunk once even if it has
+    more than one non bug fixing label.
+    """
+    hunk = {
+        "content": "- A\n+ B\n+ C",
+        "lines_verified": {"bugfix": [0], "refactoring": [1], "unrelated": [2]},
+    }
+    assert count_tangled_hunks([("abc123", hunk)])["abc123"] == 1
+
+
+def test_count_tangled_hunks_without_lines_verified():
+    """
+    Test count_tangled_hunks() with a hunk that has no lines_verified field.
+    """
+    hunk = {"content": "- A\n+ B"}
+    assert count_tangled_hunks([("abc123", hunk)]).get("abc123", 0) == 0
+
+
+def test_count_tangled_hunks_by_commit():
+    """
+    Test that count_tangled_hunks() counts the tangled hunks of each commit separately.
+    """
+    tangled_hunk = {
+        "content": "- A\n+ B",
+        "lines_verified": {"bugfix": [0], "refactoring": [1]},
+    }
+    fix_hunk = {"content": "- A\n+ B", "lines_verified": {"bugfix": [0, 1]}}
+    counts = count_tangled_hunks(
+        [
+            ("abc123", tangled_hunk),
+            ("abc123", fix_hunk),
+            ("abc123", tangled_hunk),
+            ("def456", tangled_hunk),
+        ]
+    )
+    assert counts.to_dict() == {"abc123": 2, "def456": 1}
+
+
+@pytest.mark.parametrize(
+    "path,expected",
+    [
+        ("src/main/java/Foo.java", True),
+        ("src/main/java/Foo.javax", False),
+        ("README.md", False),
+    ],
+)
+def test_java_file_regex(path, expected):
+    """
+    Test JAVA_FILE_REGEX with Java and non-Java paths.
+    """
+    assert (JAVA_FILE_REGEX.search(path) is not None) == expected
+
+
+@pytest.mark.parametrize(
+    "path,expected",
+    [
+        ("src/test/java/Foo.java", True),
+        ("tests/Foo.java", True),
+        ("src/main/java/FooTest.java", True),
+        ("src/main/java/FooTests.java", True),
+        ("src/main/java/Foo.java", False),
+        ("src/main/java/TestFoo.java", False),
+    ],
+)
+def test_test_file_regex(path, expected):
+    """
+    Test TEST_FILE_REGEX with test and non-test paths.
+    """
+    assert (TEST_FILE_REGEX.search(path) is not None) == expected
+
+
+def make_file_action(commit_hash: str, lines_verified):
+    """
+    Helper function to generate a file action as returned by the aggregation pipeline.
+
+    Arguments:
+    - commit_hash: hash of the commit of the file action.
+    - lines_verified: dictionnary of labels for each line of the file action's single hunk.
+    """
+    return {
+        "revision_hash": commit_hash,
+        "hunks": [{"content": "+ A\n+ B\n+ C", "lines_verified": lines_verified}],
+    }
+
+
+def test_count_tangled_changes_by_commit_all_file_actions():
+    """
+    Test that count_tangled_changes_by_commit() counts the tangled changes of
+    every file action of a commit, not only of the first analysed one.
+    """
+    file_actions = [
+        make_file_action("abc123", {"bugfix": [0], "refactoring": [0]}),
+        make_file_action("abc123", {"bugfix": [1], "unrelated": [1]}),
+        make_file_action("def456", {"bugfix": [0]}),
+    ]
+    counts = count_tangled_changes_by_commit(file_actions, count_tangled_lines)
+    assert counts == {"abc123": 2}
+
+
+def test_bugfix_file_actions_pipeline_filters_files_before_hunks():
+    """
+    Test that the pipeline drops test files and non-Java files before joining
+    the hunks, so that their hunks are never sent by the database.
+    """
+    pipeline = bugfix_file_actions_pipeline(ObjectId())
+    path_match = next(
+        i for i, stage in enumerate(pipeline) if "path" in stage.get("$match", {})
+    )
+    hunk_lookup = next(
+        i
+        for i, stage in enumerate(pipeline)
+        if stage.get("$lookup", {}).get("as") == "hunks"
+    )
+    assert path_match < hunk_lookup